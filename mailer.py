@@ -7,35 +7,112 @@
 from __future__ import annotations
 
 import argparse
-from collections import Counter
-import configparser
+from contextlib import ExitStack
 import csv
-from dataclasses import dataclass
-from email.message import EmailMessage
+from dataclasses import dataclass, field
+import functools
 from getpass import getpass
+from itertools import chain
 import json
+import os
 from pathlib import Path
-import smtplib
-import ssl
-import subprocess
+import queue
+import re
 from string import Template
-from typing import cast, Literal, Protocol
-import uuid
+import tempfile
+import threading
+import time
+from typing import (Callable, IO, Iterable, Iterator, Literal, Mapping,
+                    Protocol, TYPE_CHECKING)
 
+# smtplib, ssl, email and the other modules that are only needed for
+# sending emails are imported where they are used, so that they don't
+# slow down the start of the check and print commands.
+if TYPE_CHECKING:
+    from email.message import EmailMessage
+    import ssl
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class DisplayAddress:
     email: str
     name: str | None = None
+    # Cached results of the methods below. They are computed on first
+    # use, since most of them are only ever needed for the sender
+    # address, which is the same for every email that we send.
+    _formatted: str | None = field(init=False, repr=False, compare=False,
+                                   default=None)
+    _domain: str | None = field(init=False, repr=False, compare=False,
+                                default=None)
+    _header: str | None = field(init=False, repr=False, compare=False,
+                                default=None)
 
     def __str__(self) -> str:
-        if self.name is None:
-            return self.email
-        else:
-            return f'{self.name} <{self.email}>'
+        if self._formatted is None:
+            if self.name is None:
+                formatted = self.email
+            else:
+                formatted = f'{self.name} <{self.email}>'
+            # We cannot assign to the fields of a frozen dataclass directly.
+            object.__setattr__(self, '_formatted', formatted)
+            return formatted
+        return self._formatted
+
+    @property
+    def domain(self) -> str:
+        """The domain part of the email address, including the @."""
+        if self._domain is None:
+            domain = self.email[self.email.rfind('@'):]
+            object.__setattr__(self, '_domain', domain)
+            return domain
+        return self._domain
 
+    def as_header(self) -> str:
+        """Format the address for use in a raw email header."""
+        if self._header is None:
+            check_header_value(self.email)
+            if self.name is not None:
+                check_header_value(self.name)
+            from email.utils import formataddr
+            header = formataddr((self.name, self.email), charset='utf-8')
+            object.__setattr__(self, '_header', header)
+            return header
+        return self._header
 
-@dataclass
+
+# RFC 5322 limit on the length of a line without the trailing CRLF.
+MAX_LINE_LENGTH = 998
+
+# Headers that are the same for every email that we send.
+STATIC_HEADERS = ('MIME-Version: 1.0\r\n'
+                  'Content-Type: text/plain; charset="utf-8"\r\n'
+                  'Content-Transfer-Encoding: 8bit\r\n')
+
+LINE_END_RE = re.compile(r'\r\n|\r|\n')
+LEADING_DOT_RE = re.compile(br'(?m)^\.')
+
+
+def make_message_id(domain: str) -> str:
+    return f'<{os.urandom(16).hex()}{domain}>'
+
+
+def check_header_value(value: str) -> None:
+    # Line breaks would allow injecting additional headers.
+    if '\r' in value or '\n' in value:
+        raise ValueError('Header values may not contain linefeed '
+                         'or carriage return characters')
+
+
+def encode_header(name: str, value: str) -> str:
+    check_header_value(value)
+    if value.isascii():
+        return value
+    from email.header import Header
+    # The raw message uses CRLF line endings, also for folded headers.
+    return Header(value, 'utf-8', header_name=name).encode(linesep='\r\n')
+
+
+@dataclass(slots=True)
 class Email:
     subject: str
     body: str
@@ -43,30 +120,212 @@ class Email:
     to_address: DisplayAddress
 
     def as_mime(self) -> EmailMessage:
+        from email.message import EmailMessage
         msg = EmailMessage()
         msg.set_content(self.body)
         msg['Subject'] = self.subject
         msg['From'] = str(self.from_address)
         msg['To'] = str(self.to_address)
-        from_email = self.from_address.email
-        message_id = '<' + str(uuid.uuid4()) \
-                     + from_email[from_email.rfind('@'):] + '>'
-        msg['Message-ID'] = message_id
+        msg['Message-ID'] = make_message_id(self.from_address.domain)
         return msg
 
+    def as_bytes(self) -> bytes:
+        """Render the email as a raw message to be passed to SMTP.sendmail.
+
+        This is a lot cheaper than going through as_mime(), which is
+        only used as a fallback for bodies with lines that are too long
+        to be sent as 8bit text.
+        """
+        body = LINE_END_RE.sub('\r\n', self.body)
+        if not body.endswith('\r\n'):
+            body += '\r\n'
+        raw_body = body.encode()
+        if any(len(line) > MAX_LINE_LENGTH
+               for line in raw_body.split(b'\r\n')):
+            from email.policy import SMTP
+            return self.as_mime().as_bytes(policy=SMTP)
+        subject = encode_header('Subject', self.subject)
+        message_id = make_message_id(self.from_address.domain)
+        headers = (f'From: {self.from_address.as_header()}\r\n'
+                   f'To: {self.to_address.as_header()}\r\n'
+                   f'Subject: {subject}\r\n'
+                   f'Message-ID: {message_id}\r\n'
+                   + STATIC_HEADERS
+                   + '\r\n')
+        return headers.encode() + raw_body
+
+
+@dataclass
+class CompiledTemplate:
+    """A PEP 292 template split up into literal text and identifiers.
+
+    segments contains the text between the placeholders, so it always
+    has one more element than idents.
+    """
+    segments: list[str]
+    idents: list[str]
+
+    @classmethod
+    def compile(cls,
+                name: str,
+                source: str,
+                start: int = 0,
+                end: int | None = None,
+                ) -> CompiledTemplate:
+        """Compile source[start:end] of the template with the given name.
+
+        Passing the whole template file with the bounds of the part to
+        compile makes errors refer to the right position in the file.
+        """
+        if end is None:
+            end = len(source)
+        segments = []
+        idents = []
+        literal = []
+        pos = start
+        for mo in Template.pattern.finditer(source, start, end):
+            literal.append(source[pos:mo.start()])
+            pos = mo.end()
+            if mo.group('escaped') is not None:
+                literal.append(Template.delimiter)
+                continue
+            ident = mo.group('named') or mo.group('braced')
+            if ident is None:
+                cls._invalid(name, source, mo.start('invalid'))
+            segments.append(''.join(literal))
+            literal = []
+            idents.append(ident)
+        literal.append(source[pos:end])
+        segments.append(''.join(literal))
+        return cls(segments=segments, idents=idents)
+
+    @staticmethod
+    def _invalid(name: str, source: str, i: int) -> None:
+        # Same position as reported by Template.substitute for the whole
+        # template file.
+        lines = source[:i].splitlines(keepends=True)
+        if not lines:
+            colno = 1
+            lineno = 1
+        else:
+            colno = i - len(''.join(lines[:-1]))
+            lineno = len(lines)
+        raise ValueError(f'Invalid placeholder in template {name}: '
+                         f'line {lineno}, col {colno}')
+
+    @classmethod
+    def from_cache(cls, segments: list[str], idents: list[str]
+                   ) -> CompiledTemplate:
+        """Restore a compiled template from the Templates cache."""
+        if not (isinstance(segments, list) and isinstance(idents, list)
+                and len(segments) == len(idents) + 1
+                and all(isinstance(s, str) for s in segments)
+                and all(isinstance(i, str) for i in idents)):
+            raise ValueError('Invalid compiled template in cache.')
+        return cls(segments=segments, idents=idents)
+
+    def substitute(self, content: Mapping[str, str]) -> str:
+        values = [content[ident] for ident in self.idents]
+        return ''.join(chain.from_iterable(zip(self.segments, values))) \
+               + self.segments[-1]
+
+
+@dataclass
+class MailTemplate:
+    subject: CompiledTemplate
+    body: CompiledTemplate
+
+    @classmethod
+    def parse(cls, name: str, source: str) -> MailTemplate:
+        subject_line, _, body = source.partition('\n')
+        if not subject_line.startswith('Subject: '):
+            raise RuntimeError(f'Missing Subject line in template {name}.')
+        body_start = len(source) - len(body.lstrip())
+        return cls(subject=CompiledTemplate.compile(name, source,
+                                                    len('Subject: '),
+                                                    len(subject_line)),
+                   body=CompiledTemplate.compile(name, source, body_start))
+
 
 class Templates:
-    def __init__(self, templates_dir: Path):
+    # The cache is a JSON object that maps template names to
+    # [mtime_ns, size, subject_segments, subject_idents,
+    #  body_segments, body_idents].
+    # Entries in another format fail to unpack, which makes us ignore the
+    # whole cache.
+    cache_name = '.template_cache.json'
+
+    def __init__(self, templates_dir: Path, *, display_names: bool = False):
         self.templates_dir = templates_dir
-        self.templates: dict[str, Template] = {}
+        self.templates: dict[str, MailTemplate] = {}
+        # The (st_mtime_ns, st_size) of the template files when they were
+        # read, a cached template is only used if both still match.
+        self.file_stats: dict[str, tuple[int, int]] = {}
+        # Whether the CSV file has firstname and lastname fields to build
+        # the display names of the recipients from.
+        self.display_names = display_names
+        self._load_cache()
+
+    @property
+    def cache_path(self) -> Path:
+        return self.templates_dir / self.cache_name
+
+    def _load_cache(self) -> None:
+        try:
+            with self.cache_path.open(encoding='utf-8') as f:
+                cached = json.load(f)
+            entries = {
+                name: ((mtime, size), MailTemplate(
+                    subject=CompiledTemplate.from_cache(subject_segments,
+                                                        subject_idents),
+                    body=CompiledTemplate.from_cache(body_segments,
+                                                     body_idents)))
+                for name, (mtime, size,
+                           subject_segments, subject_idents,
+                           body_segments, body_idents) in cached.items()}
+        except (OSError, ValueError, TypeError, AttributeError):
+            # A missing or invalid cache just means that we have to
+            # read all templates from disk again.
+            return
+        for name, (file_stat, template) in entries.items():
+            try:
+                st = (self.templates_dir / name).stat()
+            except OSError:
+                continue
+            if (st.st_mtime_ns, st.st_size) == file_stat:
+                self.templates[name] = template
+                self.file_stats[name] = file_stat
 
-    def add_template(self, name: str) -> Template:
+    def _save_cache(self) -> None:
+        cached = {name: [*self.file_stats[name],
+                         template.subject.segments, template.subject.idents,
+                         template.body.segments, template.body.idents]
+                  for name, template in self.templates.items()}
+        # The cache is only an optimization, so don't fail if we cannot
+        # write it, e.g. because the templates directory is read-only.
+        try:
+            fd, tmp_name = tempfile.mkstemp(dir=self.templates_dir,
+                                            prefix=self.cache_name + '.',
+                                            suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(cached, f)
+            os.replace(tmp_name, self.cache_path)
+        except OSError:
+            os.unlink(tmp_name)
+
+    def add_template(self, name: str) -> MailTemplate:
         with (self.templates_dir / name).open() as f:
-            template = Template(f.read())
+            st = os.fstat(f.fileno())
+            template = MailTemplate.parse(name, f.read())
         self.templates[name] = template
+        self.file_stats[name] = (st.st_mtime_ns, st.st_size)
+        self._save_cache()
         return template
 
-    def __getitem__(self, key: str) -> Template:
+    def __getitem__(self, key: str) -> MailTemplate:
         try:
             template = self.templates[key]
         except KeyError:
@@ -76,25 +335,20 @@ class Templates:
     def create_message(self,
                        template_name: str,
                        *,
-                       content: dict[str, str],
+                       content: Mapping[str, str],
                        sender_address: DisplayAddress,
                        ) -> Email:
-        try:
-            to_name = '{firstname} {lastname}'.format_map(content)
-        except KeyError:
-            to_name = None
+        to_name = None
+        if self.display_names:
+            try:
+                to_name = content['firstname'] + ' ' + content['lastname']
+            except KeyError:
+                # The row is shorter than the header.
+                pass
         to_address = DisplayAddress(name=to_name, email=content['email'])
-        filled = self[template_name].substitute(content)
-        if not filled.startswith('Subject: '):
-            raise RuntimeError(f'Missing Subject line in template {template_name}.')
-        end_of_subject = filled.find('\n')
-        subject = filled[:end_of_subject].removeprefix('Subject: ')
-        body = filled[end_of_subject+1:].lstrip()
-        msg = EmailMessage()
-        msg.set_content(body)
-        msg['Subject'] = subject
-        msg['From'] = str(sender_address)
-        msg['To'] = to_address
+        template = self[template_name]
+        subject = template.subject.substitute(content)
+        body = template.body.substitute(content)
         return Email(
                 subject=subject,
                 body=body,
@@ -114,26 +368,161 @@ class Sender(Protocol):
     def sender_address(self) -> DisplayAddress: ...
 
 
+@functools.cache
+def default_ssl_context() -> ssl.SSLContext:
+    # Loading the system's trusted certificates is expensive, so share a
+    # single context between all connections and reconnects.
+    import ssl
+    return ssl.create_default_context()
+
+
 class SMTPSender:
+    # Seconds without sending anything after which we check with a NOOP
+    # that the server hasn't closed the connection in the meantime.
+    idle_timeout = 30
+    # Seconds to wait for the server before giving up on the connection.
+    timeout = 60
+
     def __init__(self,
                  sender_address: DisplayAddress,
                  smtpserver: str,
                  smtpuser: str,
-                 smtpport: int):
+                 smtpport: int,
+                 messages_per_connection: int = 1000,
+                 password: str | None = None):
         self.sender_address = sender_address
         self.smtpserver = smtpserver
         self.smtpuser = smtpuser
         self.smtpport = smtpport
-        self.smtp = smtplib.SMTP(self.smtpserver, self.smtpport)
+        self.messages_per_connection = messages_per_connection
+        import smtplib
+        self.smtp = smtplib.SMTP(self.smtpserver, self.smtpport,
+                                 timeout=self.timeout)
+        self._password = password
+        self._last_send = time.monotonic()
+        self._sent_on_connection = 0
+
+    def clone(self) -> SMTPSender:
+        """Open another connection to the same server.
+
+        The clone reuses the password of this sender, so that calling
+        login() on it won't ask for the password again.
+        """
+        return SMTPSender(sender_address=self.sender_address,
+                          smtpserver=self.smtpserver,
+                          smtpuser=self.smtpuser,
+                          smtpport=self.smtpport,
+                          messages_per_connection=self.messages_per_connection,
+                          password=self._password)
 
     def login(self) -> None:
-        password = getpass(f'Password for {self.sender_address.email}: ')
-        context = ssl.create_default_context()
-        self.smtp.starttls(context=context)
-        self.smtp.login(self.smtpuser, password)
+        if self._password is None:
+            self._password = getpass(
+                    f'Password for {self.sender_address.email}: ')
+        self._starttls_and_login()
+
+    def _starttls_and_login(self) -> None:
+        assert self._password is not None
+        self.smtp.starttls(context=default_ssl_context())
+        self.smtp.login(self.smtpuser, self._password)
+        self._last_send = time.monotonic()
+        self._sent_on_connection = 0
+
+    def reconnect(self) -> None:
+        import smtplib
+        self.smtp.close()
+        self.smtp = smtplib.SMTP(self.smtpserver, self.smtpport,
+                                 timeout=self.timeout)
+        self._starttls_and_login()
+
+    def noop_if_idle(self) -> None:
+        import smtplib
+        if time.monotonic() - self._last_send <= self.idle_timeout:
+            return
+        try:
+            code, _ = self.smtp.noop()
+        except (smtplib.SMTPServerDisconnected, TimeoutError):
+            code = None
+        if code != 250:
+            self.reconnect()
 
     def send_message(self, msg: Email) -> None:
-        self.smtp.send_message(msg.as_mime())
+        import smtplib
+        if self._sent_on_connection >= self.messages_per_connection:
+            # Many providers limit the number of emails per connection.
+            try:
+                self.smtp.quit()
+            except smtplib.SMTPServerDisconnected:
+                pass
+            self.reconnect()
+        else:
+            self.noop_if_idle()
+        from_email = msg.from_address.email
+        to_email = msg.to_address.email
+        raw = msg.as_bytes()
+        try:
+            self._sendmail(from_email, to_email, raw)
+        except (smtplib.SMTPServerDisconnected,
+                smtplib.SMTPConnectError,
+                TimeoutError):
+            # Retry once on a fresh connection, e.g. if the server
+            # dropped us because of rate limiting.
+            self.reconnect()
+            self._sendmail(from_email, to_email, raw)
+        self._last_send = time.monotonic()
+        self._sent_on_connection += 1
+
+    def _sendmail(self, from_email: str, to_email: str, raw: bytes) -> None:
+        """Like SMTP.sendmail, but pipelines the commands if possible.
+
+        With the PIPELINING extension (RFC 2920), the MAIL, RCPT and DATA
+        commands are sent together and their replies are only read
+        afterwards, which saves two round trips per email.
+        """
+        import smtplib
+        smtp = self.smtp
+        smtp.ehlo_or_helo_if_needed()
+        if not smtp.has_extn('pipelining'):
+            smtp.sendmail(from_email, [to_email], raw)
+            return
+        smtp.send(f'MAIL FROM:{smtplib.quoteaddr(from_email)}\r\n'
+                  f'RCPT TO:{smtplib.quoteaddr(to_email)}\r\n'
+                  'DATA\r\n')
+        mail_code, mail_resp = smtp.getreply()
+        rcpt_code, rcpt_resp = smtp.getreply()
+        data_code, data_resp = smtp.getreply()
+        if mail_code != 250 or rcpt_code not in (250, 251):
+            if data_code == 354:
+                # The server shouldn't have accepted DATA, so send an
+                # empty message to get out of the DATA state.
+                smtp.send(b'.\r\n')
+                smtp.getreply()
+            self._rset()
+            if mail_code != 250:
+                raise smtplib.SMTPSenderRefused(mail_code, mail_resp,
+                                                from_email)
+            raise smtplib.SMTPRecipientsRefused(
+                    {to_email: (rcpt_code, rcpt_resp)})
+        if data_code != 354:
+            self._rset()
+            raise smtplib.SMTPDataError(data_code, data_resp)
+        data = LEADING_DOT_RE.sub(b'..', raw)
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        smtp.send(data + b'.\r\n')
+        code, resp = smtp.getreply()
+        if code != 250:
+            self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+
+    def _rset(self) -> None:
+        # Reset the transaction after an error, but the connection might
+        # already be gone, e.g. after a 421 reply.
+        import smtplib
+        try:
+            self.smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
 
     def quit(self) -> None:
         self.smtp.quit()
@@ -164,6 +553,7 @@ class ThunderbirdSender:
         command = ['thunderbird', '-compose',
                         ','.join(f"{key}='{value}'"
                                  for key, value in options.items())]
+        import subprocess
         subprocess.run(command)
         reply = input('email sent [Y/n]? ').strip().lower()
         if not reply or reply == 'y':
@@ -185,7 +575,54 @@ class ThunderbirdSender:
         self.quit()
 
 
+class CSVRow(Mapping[str, str]):
+    """Read-only view of a CSV row that maps field names to values."""
+    __slots__ = ('columns', 'values')
+
+    def __init__(self, columns: dict[str, int], values: list[str]):
+        self.columns = columns
+        self.values = values
+
+    def __getitem__(self, key: str) -> str:
+        try:
+            return self.values[self.columns[key]]
+        except IndexError:
+            # The row has less values than the header has fields.
+            raise KeyError(key) from None
+
+    def __iter__(self) -> Iterator[str]:
+        n = len(self.values)
+        return (name for name, i in self.columns.items() if i < n)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class CSVReader:
+    """Like csv.DictReader, but without building a dict for every row."""
+    def __init__(self, csvfile: Iterable[str]):
+        self.reader = csv.reader(csvfile)
+        self.fieldnames = next(self.reader, [])
+        self.columns = {name: i for i, name in enumerate(self.fieldnames)}
+
+    @property
+    def has_display_names(self) -> bool:
+        return 'firstname' in self.columns and 'lastname' in self.columns
+
+    def __iter__(self) -> Iterator[CSVRow]:
+        columns = self.columns
+        return (CSVRow(columns, values) for values in self.values())
+
+    def values(self) -> Iterator[list[str]]:
+        """Iterate over the plain lists of values of the rows."""
+        for values in self.reader:
+            # Skip empty lines like csv.DictReader does.
+            if values:
+                yield values
+
+
 def create_sender(cfg_file: Path) -> Sender:
+    import configparser
     config = configparser.ConfigParser()
     config.read(cfg_file)
     sender_config = config['sender']
@@ -197,16 +634,20 @@ def create_sender(cfg_file: Path) -> Sender:
         return ThunderbirdSender(sender_address=sender_address)
     smtpuser = sender_config.get('smtpuser', email)
     smtpport = int(sender_config.get('smtpport', '587'))
+    messages_per_connection = int(
+            sender_config.get('messagesperconnection', '1000'))
     return SMTPSender(sender_address=sender_address,
                       smtpserver=smtpserver,
                       smtpuser=smtpuser,
-                      smtpport=smtpport)
+                      smtpport=smtpport,
+                      messages_per_connection=messages_per_connection)
 
 
 def read_sender_address(csv_path: Path) -> DisplayAddress:
     sender_path = csv_path.with_name(csv_path.stem + '-sender.ini')
     if not sender_path.exists():
         raise RuntimeError(f'Please configure sender in file {sender_path}.')
+    import configparser
     config = configparser.ConfigParser()
     config.read(sender_path)
     sender_config = config['sender']
@@ -217,36 +658,49 @@ def read_sender_address(csv_path: Path) -> DisplayAddress:
 
 def check_csv(args: argparse.Namespace) -> None:
     with open(args.csv, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
+        reader = CSVReader(csvfile)
         missing_fields = [field for field in ['email', 'template']
-                          if field not in cast(str, reader.fieldnames)]
+                          if field not in reader.columns]
         if missing_fields:
             raise RuntimeError(f'Missing fields in {args.csv}: '
                                f'{", ".join(missing_fields)}')
-        emails = Counter[str]()
+        emails = set()
+        duplicate_emails = set()
         templates = set()
         for row in reader:
-            emails[row['email']] += 1
+            email = row['email']
+            if email in emails:
+                duplicate_emails.add(email)
+            else:
+                emails.add(email)
             templates.add(row['template'])
-        duplicate_emails = [email for email, count in emails.items()
-                            if count > 1]
         if duplicate_emails:
             raise RuntimeError(
                 'The following email addresses appear in more than one row: '
-                + ', '.join(duplicate_emails))
+                + ', '.join(sorted(duplicate_emails)))
         template_dir = Path(args.csv).parent / 'templates'
-        unknown_templates = [template for template in templates
-                             if not (template_dir / template).exists()]
+        try:
+            with os.scandir(template_dir) as entries:
+                template_files = {entry.name for entry in entries
+                                  if entry.is_file()}
+        except FileNotFoundError:
+            template_files = set()
+        # The listing only covers templates directly in the directory,
+        # check templates in subdirectories one by one.
+        unknown_templates = {t for t in templates - template_files
+                             if '/' not in t
+                             or not (template_dir / t).is_file()}
         if unknown_templates:
             raise RuntimeError(
                 f'The following templates were used in {args.csv}, '
                 f'but do not exist: {", ".join(unknown_templates)}')
         instantiated_templates = Templates(template_dir)
         for template in (instantiated_templates[t] for t in templates):
-            # TODO: In Python 3.11, we could use template.is_valid() and
-            #       template.get_identifiers()
-            pass # TODO: Implement check that template is valid and all
-                 #       identifiers have been provided in the CSV file.
+            # Invalid placeholders are already reported when compiling
+            # the template.
+            pass # TODO: Implement check that all identifiers of
+                 #       template.subject and template.body have been
+                 #       provided in the CSV file.
 
 
 def print_mail(args: argparse.Namespace) -> None:
@@ -254,9 +708,10 @@ def print_mail(args: argparse.Namespace) -> None:
     csv_path = Path(args.csv)
     sender = read_sender_address(csv_path)
     template_dir = csv_path.parent / 'templates'
-    templates = Templates(template_dir)
     with open(csv_path, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
+        reader = CSVReader(csvfile)
+        templates = Templates(template_dir,
+                              display_names=reader.has_display_names)
         for row in reader:
             if row['email'] != email:
                 continue
@@ -271,7 +726,7 @@ def print_mail(args: argparse.Namespace) -> None:
             raise RuntimeError(f'{email} not found in {args.csv}.')
 
 
-@dataclass
+@dataclass(slots=True)
 class LogEntry:
     email: str
     status: Literal['sent', 'failure']
@@ -295,56 +750,246 @@ class LogEntry:
         return cls(**content)
 
     def to_json(self) -> str:
-        d = {'email': self.email,
-             'status': self.status,
-             }
-        if self.failure_reason is not None:
-            d['failure_reason'] = self.failure_reason
-        return json.dumps(d)
+        # Same output as json.dumps() of a dict of the fields, but only the
+        # free-form strings need to be escaped, since status is one of a
+        # few known words.
+        email = json.dumps(self.email)
+        if self.failure_reason is None:
+            return f'{{"email": {email}, "status": "{self.status}"}}\n'
+        reason = json.dumps(self.failure_reason)
+        return (f'{{"email": {email}, "status": "{self.status}", '
+                f'"failure_reason": {reason}}}\n')
+
+
+# Number of log entries that are collected before they are written and
+# synced to disk together.
+LOG_BATCH_SIZE = 64
+
+# Seconds after which an incomplete batch of log entries is written out,
+# so that slowly sent emails are logged right away.
+LOG_BATCH_TIMEOUT = 0.1
+
+
+def sync_file(f: IO[str]) -> None:
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class SendLog:
+    """The log of sent emails and the index of successfully sent addresses.
+
+    Entries are collected and written to disk in batches of LOG_BATCH_SIZE
+    entries, but failures are written and synced right away, and so is
+    every entry recorded more than LOG_BATCH_TIMEOUT seconds after the
+    last write.
+    """
+    def __init__(self, log_path: Path, index_path: Path):
+        self.log_path = log_path
+        self.index_path = index_path
+        self._log_lines: list[str] = []
+        self._index_lines: list[str] = []
+        self._last_flush = time.monotonic()
+
+    def __enter__(self) -> SendLog:
+        self.log_file = self.log_path.open('a', buffering=1<<16)
+        self.index_file = self.index_path.open('a', buffering=1<<16)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            self.flush()
+        finally:
+            try:
+                self.index_file.close()
+            finally:
+                self.log_file.close()
+
+    def record(self, entry: LogEntry) -> None:
+        self._log_lines.append(entry.to_json())
+        if entry.was_successful:
+            self._index_lines.append(entry.email + '\n')
+            if (len(self._log_lines) < LOG_BATCH_SIZE
+                    and time.monotonic() - self._last_flush
+                        < LOG_BATCH_TIMEOUT):
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        """Write and sync all collected entries to disk."""
+        self._last_flush = time.monotonic()
+        if not self._log_lines:
+            return
+        self.log_file.writelines(self._log_lines)
+        self.index_file.writelines(self._index_lines)
+        self._log_lines.clear()
+        self._index_lines.clear()
+        sync_file(self.log_file)
+        sync_file(self.index_file)
+
+
+def rebuild_sent_index(send_log_path: Path, sent_index_path: Path) -> None:
+    status = {}
+    if send_log_path.exists():
+        with send_log_path.open() as f:
+            for line in f:
+                log_entry = LogEntry.from_json(line)
+                status[log_entry.email] = log_entry
+    tmp_path = sent_index_path.with_name(sent_index_path.name + '.tmp')
+    with tmp_path.open('w') as f:
+        f.writelines(email + '\n' for email, log_entry in status.items()
+                     if log_entry.was_successful)
+    os.replace(tmp_path, sent_index_path)
+
+
+def read_sent_emails(send_log_path: Path, sent_index_path: Path) -> set[str]:
+    if not sent_index_path.exists():
+        rebuild_sent_index(send_log_path, sent_index_path)
+    with sent_index_path.open() as f:
+        return set(f.read().splitlines())
+
+
+def send_rows(sender: Sender,
+              templates: Templates,
+              rows: Iterator[CSVRow],
+              rows_lock: threading.Lock,
+              record: Callable[[LogEntry], None],
+              abort: threading.Event) -> None:
+    while not abort.is_set():
+        with rows_lock:
+            row = next(rows, None)
+        if row is None:
+            return
+        to = row['email']
+        try:
+            msg = templates.create_message(
+                    row['template'],
+                    content=row,
+                    sender_address=sender.sender_address,
+            )
+            # print(msg)
+            sender.send_message(msg)
+            print(f'Sent to {to}')
+        except Exception as e:
+            record(LogEntry.failure(email=to, reason=str(e)))
+            raise
+        else:
+            record(LogEntry.success(email=to))
+
+
+class SendWorker(threading.Thread):
+    """Thread that sends emails for rows over its own sender.
+
+    Instead of writing to the send log itself, it puts its log entries
+    onto results and finally puts None there once it is done.
+    """
+    def __init__(self,
+                 sender: Sender,
+                 templates: Templates,
+                 rows: Iterator[CSVRow],
+                 rows_lock: threading.Lock,
+                 results: queue.Queue[LogEntry | None],
+                 abort: threading.Event):
+        super().__init__()
+        self.sender = sender
+        self.templates = templates
+        self.rows = rows
+        self.rows_lock = rows_lock
+        self.results = results
+        self.abort = abort
+        self.error: Exception | None = None
+
+    def run(self) -> None:
+        try:
+            send_rows(self.sender, self.templates, self.rows, self.rows_lock,
+                      self.results.put, self.abort)
+        except Exception as e:
+            self.error = e
+            self.abort.set()
+        finally:
+            self.results.put(None)
+
+
+def send_parallel(senders: list[Sender],
+                  template_dir: Path,
+                  display_names: bool,
+                  rows: Iterator[CSVRow],
+                  send_log: SendLog) -> None:
+    rows_lock = threading.Lock()
+    results: queue.Queue[LogEntry | None] = queue.Queue()
+    abort = threading.Event()
+    # Every worker gets its own Templates, so that they don't have to
+    # synchronize access to it.
+    workers = [SendWorker(sender,
+                          Templates(template_dir, display_names=display_names),
+                          rows, rows_lock, results, abort)
+               for sender in senders]
+    for worker in workers:
+        worker.start()
+    try:
+        running = len(workers)
+        while running:
+            try:
+                entry = results.get(timeout=LOG_BATCH_TIMEOUT)
+            except queue.Empty:
+                send_log.flush()
+                continue
+            if entry is None:
+                running -= 1
+            else:
+                send_log.record(entry)
+    finally:
+        abort.set()
+        for worker in workers:
+            worker.join()
+        # Record emails that have still been sent after we got interrupted.
+        while not results.empty():
+            entry = results.get()
+            if entry is not None:
+                send_log.record(entry)
+    for worker in workers:
+        if worker.error is not None:
+            raise worker.error
 
 
 def send_all_emails(args: argparse.Namespace) -> None:
     csv_path = Path(args.csv)
     send_log_path = csv_path.with_name(csv_path.stem + '-sent.log')
+    sent_index_path = csv_path.with_name(csv_path.stem + '-sent.idx')
     template_dir = csv_path.parent / 'templates'
-    templates = Templates(template_dir)
     sender_path = csv_path.with_name(csv_path.stem + '-sender.ini')
     if not sender_path.exists():
         raise RuntimeError(f'Please configure sender in file {sender_path}.')
-    status = {}
-    if not send_log_path.exists():
-        send_log_path.touch()
-    else:
-        with send_log_path.open() as f:
-            for line in f:
-                log_entry = LogEntry.from_json(line)
-                status[log_entry.email] = log_entry
+    sent = read_sent_emails(send_log_path, sent_index_path)
     with (open(csv_path, newline='') as csvfile,
-          send_log_path.open('a') as log_file,
-          create_sender(sender_path) as sender):
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            to = row['email']
-            if status.get(to) is not None and status[to].was_successful:
-                continue
-            try:
-                msg = templates.create_message(
-                        row['template'],
-                        content=row,
-                        sender_address=sender.sender_address,
-                )
-                # print(msg)
-                sender.send_message(msg)
-                print(f'Sent to {to}')
-            except Exception as e:
-                log_file.write(LogEntry.failure(email=to, reason=str(e))
-                                       .to_json())
-                log_file.write('\n')
-                raise
-            else:
-                log_file.write(LogEntry.success(email=row['email'])
-                                       .to_json())
-                log_file.write('\n')
+          SendLog(send_log_path, sent_index_path) as send_log,
+          create_sender(sender_path) as sender,
+          ExitStack() as stack):
+        reader = CSVReader(csvfile)
+        display_names = reader.has_display_names
+        columns = reader.columns
+        email_column = columns['email']
+        # Skip rows that were already sent before creating their CSVRow.
+        rows = (CSVRow(columns, values) for values in reader.values()
+                if len(values) <= email_column
+                or values[email_column] not in sent)
+        # Only SMTP can send several emails in parallel, Thunderbird
+        # asks the user to confirm every email.
+        if not isinstance(sender, SMTPSender) or args.workers == 1:
+            templates = Templates(template_dir, display_names=display_names)
+            send_rows(sender, templates, rows, threading.Lock(),
+                      send_log.record, threading.Event())
+            return
+        senders: list[Sender] = [sender]
+        senders += [stack.enter_context(sender.clone())
+                    for _ in range(args.workers - 1)]
+        send_parallel(senders, template_dir, display_names, rows, send_log)
+
+
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return n
 
 
 def create_argparser() -> argparse.ArgumentParser:
@@ -370,6 +1015,10 @@ def create_argparser() -> argparse.ArgumentParser:
     send_all.add_argument(
             'csv',
             help='csv file with email addresses and data to fill into templates')
+    send_all.add_argument(
+            '--workers', type=positive_int, default=4,
+            help='number of SMTP connections to send emails over in parallel '
+                 '(default: %(default)s)')
     send_all.set_defaults(command=send_all_emails)
     return aparser
 
@@ -0,0 +1,441 @@
+# SPDX-FileCopyrightText: 2023 Felix Gruber <felgru@posteo.net>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import io
+import os
+from pathlib import Path
+import re
+import smtplib
+import socketserver
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import mailer
+from mailer import (CSVReader, CSVRow, DisplayAddress, Email, LogEntry,
+                    MailTemplate, SMTPSender, SendLog, Templates, check_csv,
+                    read_sent_emails, rebuild_sent_index)
+
+
+def make_email(subject: str = 'Hello',
+               body: str = 'Hi!\n',
+               to_name: str | None = 'John Doe',
+               to_email: str = 'john.doe@example.com') -> Email:
+    return Email(subject=subject,
+                 body=body,
+                 from_address=DisplayAddress(email='me@example.com',
+                                             name='Me Myself'),
+                 to_address=DisplayAddress(email=to_email, name=to_name))
+
+
+class TestDisplayAddress(unittest.TestCase):
+    def test_str(self):
+        self.assertEqual(str(DisplayAddress(email='a@example.com')),
+                         'a@example.com')
+        address = DisplayAddress(email='a@example.com', name='A B')
+        self.assertEqual(str(address), 'A B <a@example.com>')
+        self.assertEqual(str(address), 'A B <a@example.com>')
+
+    def test_domain(self):
+        address = DisplayAddress(email='a@example.com')
+        self.assertEqual(address.domain, '@example.com')
+        self.assertEqual(address, DisplayAddress(email='a@example.com'))
+
+
+class TestEmailAsBytes(unittest.TestCase):
+    def assertNoBareLineEnds(self, raw: bytes) -> None:
+        self.assertIsNone(re.search(rb'\r(?!\n)|(?<!\r)\n', raw))
+
+    def test_long_non_ascii_subject_is_folded_with_crlf(self):
+        raw = make_email(subject='Ünïcödé ' * 20).as_bytes()
+        self.assertNoBareLineEnds(raw)
+        headers = raw.split(b'\r\n\r\n', 1)[0]
+        subject_lines = [line for line in headers.split(b'\r\n')
+                         if line.startswith((b'Subject: ', b' '))]
+        self.assertGreater(len(subject_lines), 1)
+        self.assertTrue(all(len(line) <= 78 for line in subject_lines))
+
+    def test_line_break_in_display_name_is_rejected(self):
+        with self.assertRaises(ValueError):
+            make_email(to_name='Evil\nBcc: x@example.com').as_bytes()
+
+    def test_line_break_in_subject_is_rejected(self):
+        with self.assertRaises(ValueError):
+            make_email(subject='Hello\r\nBcc: x@example.com').as_bytes()
+
+
+class TestMailTemplate(unittest.TestCase):
+    def test_parse(self):
+        template = MailTemplate.parse(
+                'friends', 'Subject: Hi $name\n\n  Dear ${name}, $$5.\n')
+        content = {'name': 'John'}
+        self.assertEqual(template.subject.substitute(content), 'Hi John')
+        self.assertEqual(template.body.substitute(content),
+                         'Dear John, $5.\n')
+
+    def test_invalid_placeholder_position_refers_to_file(self):
+        source = 'Subject: hi\n\nline a\nline b $ bad\n'
+        with self.assertRaisesRegex(
+                ValueError, 'in template friends: line 4, col 8'):
+            MailTemplate.parse('friends', source)
+
+    def test_invalid_placeholder_in_subject(self):
+        with self.assertRaisesRegex(ValueError, 'line 1, col 13'):
+            MailTemplate.parse('friends', 'Subject: hi $\nbody\n')
+
+
+class TestTemplates(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.templates_dir = Path(tmp_dir.name)
+        (self.templates_dir / 'friends').write_text(
+                'Subject: Hi $name\n\nDear $name,\n')
+
+    def test_cache_is_reused(self):
+        template = Templates(self.templates_dir)['friends']
+        cached = Templates(self.templates_dir)
+        self.assertEqual(cached.templates, {'friends': template})
+
+    def test_modified_template_is_read_again(self):
+        Templates(self.templates_dir)['friends']
+        path = self.templates_dir / 'friends'
+        path.write_text('Subject: Bye $name\n\nDear $name,\n')
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        template = Templates(self.templates_dir)['friends']
+        self.assertEqual(template.subject.substitute({'name': 'John'}),
+                         'Bye John')
+
+    def test_resized_template_is_read_again(self):
+        Templates(self.templates_dir)['friends']
+        path = self.templates_dir / 'friends'
+        stat = path.stat()
+        path.write_text('Subject: Goodbye $name\n\nDear $name,\n')
+        # The file was changed within the resolution of its mtime.
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        template = Templates(self.templates_dir)['friends']
+        self.assertEqual(template.subject.substitute({'name': 'John'}),
+                         'Goodbye John')
+
+    def test_invalid_cache_is_ignored(self):
+        cache_path = self.templates_dir / Templates.cache_name
+        for content in ['[1, 2', '[1, 2]', '{"friends": [0, ["a"], []]}',
+                        '{"friends": [0, [1], [], [""], []]}']:
+            cache_path.write_text(content)
+            self.assertEqual(Templates(self.templates_dir).templates, {})
+
+    def create_messages(self, csv: str) -> list[Email]:
+        reader = CSVReader(io.StringIO(csv))
+        templates = Templates(self.templates_dir,
+                              display_names=reader.has_display_names)
+        sender = DisplayAddress(email='me@example.com')
+        return [templates.create_message('friends',
+                                         content=row,
+                                         sender_address=sender)
+                for row in reader]
+
+    def test_display_names_are_taken_from_header(self):
+        (self.templates_dir / 'friends').write_text('Subject: Hi\n\nHi!\n')
+        for csv in ['email,template,firstname,lastname\n'
+                    'a@x.com,friends\n'
+                    'b@x.com,friends,Bob,Smith\n',
+                    'email,template,firstname,lastname\n'
+                    'b@x.com,friends,Bob,Smith\n'
+                    'a@x.com,friends\n']:
+            with self.subTest(csv=csv):
+                names = {msg.to_address.email: msg.to_address.name
+                         for msg in self.create_messages(csv)}
+                self.assertEqual(names, {'a@x.com': None,
+                                         'b@x.com': 'Bob Smith'})
+
+    def test_no_display_names_without_name_fields(self):
+        msg, = self.create_messages('email,template,name\n'
+                                    'a@x.com,friends,Ann\n')
+        self.assertIsNone(msg.to_address.name)
+
+
+class TestCheckCSV(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.csv_path = Path(tmp_dir.name) / 'campaign.csv'
+        self.templates_dir = Path(tmp_dir.name) / 'templates'
+        (self.templates_dir / 'es').mkdir(parents=True)
+        (self.templates_dir / 'friends').write_text('Subject: Hi\n\nHi!\n')
+        (self.templates_dir / 'es' / 'friends').write_text(
+                'Subject: Hola\n\nHola!\n')
+
+    def check(self, *templates: str) -> None:
+        self.csv_path.write_text(
+                'email,template\n'
+                + ''.join(f'{i}@example.com,{template}\n'
+                          for i, template in enumerate(templates)))
+        check_csv(argparse.Namespace(csv=str(self.csv_path)))
+
+    def test_templates_exist(self):
+        self.check('friends', 'es/friends')
+
+    def test_unknown_template(self):
+        (self.templates_dir / 'es' / 'family').mkdir()
+        for template in ['family', 'es/family', 'es']:
+            with self.subTest(template=template):
+                with self.assertRaisesRegex(RuntimeError, template):
+                    self.check('friends', template)
+
+
+class TestSendLog(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.log_path = Path(tmp_dir.name) / 'campaign-sent.log'
+        self.index_path = Path(tmp_dir.name) / 'campaign-sent.idx'
+
+    def logged_emails(self) -> list[str]:
+        with self.log_path.open() as f:
+            return [LogEntry.from_json(line).email for line in f]
+
+    def test_slow_entries_are_written_right_away(self):
+        with SendLog(self.log_path, self.index_path) as send_log:
+            with mock.patch.object(mailer, 'LOG_BATCH_TIMEOUT', 0):
+                send_log.record(LogEntry.success('a@example.com'))
+                self.assertEqual(self.logged_emails(), ['a@example.com'])
+            with mock.patch.object(mailer, 'LOG_BATCH_TIMEOUT', 3600):
+                send_log.record(LogEntry.success('b@example.com'))
+                self.assertEqual(self.logged_emails(), ['a@example.com'])
+        self.assertEqual(self.logged_emails(),
+                         ['a@example.com', 'b@example.com'])
+
+    def indexed_emails(self) -> list[str]:
+        return self.index_path.read_text().splitlines()
+
+    def test_entries_are_written_in_batches(self):
+        emails = [f'{i}@example.com' for i in range(mailer.LOG_BATCH_SIZE)]
+        with mock.patch.object(mailer, 'LOG_BATCH_TIMEOUT', 3600), \
+             SendLog(self.log_path, self.index_path) as send_log:
+            for email in emails[:-1]:
+                send_log.record(LogEntry.success(email))
+            self.assertEqual(self.logged_emails(), [])
+            send_log.record(LogEntry.success(emails[-1]))
+            self.assertEqual(self.logged_emails(), emails)
+            self.assertEqual(self.indexed_emails(), emails)
+
+    def test_failures_are_written_right_away(self):
+        with mock.patch.object(mailer, 'LOG_BATCH_TIMEOUT', 3600), \
+             SendLog(self.log_path, self.index_path) as send_log:
+            send_log.record(LogEntry.success('a@example.com'))
+            send_log.record(LogEntry.failure('b@example.com', 'refused'))
+            self.assertEqual(self.logged_emails(),
+                             ['a@example.com', 'b@example.com'])
+            self.assertEqual(self.indexed_emails(), ['a@example.com'])
+
+
+class TestSentIndex(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.log_path = Path(tmp_dir.name) / 'campaign-sent.log'
+        self.index_path = Path(tmp_dir.name) / 'campaign-sent.idx'
+
+    def test_rebuild_from_log(self):
+        self.log_path.write_text(''.join(entry.to_json() for entry in [
+                LogEntry.success('a@example.com'),
+                LogEntry.failure('b@example.com', 'refused'),
+                LogEntry.failure('c@example.com', 'refused'),
+                LogEntry.success('c@example.com'),
+                LogEntry.success('d@example.com'),
+                LogEntry.failure('d@example.com', 'bounced'),
+        ]))
+        rebuild_sent_index(self.log_path, self.index_path)
+        self.assertEqual(self.index_path.read_text(),
+                         'a@example.com\nc@example.com\n')
+
+    def test_missing_index_is_rebuilt(self):
+        self.log_path.write_text(LogEntry.success('a@example.com').to_json())
+        self.assertEqual(read_sent_emails(self.log_path, self.index_path),
+                         {'a@example.com'})
+        self.assertTrue(self.index_path.exists())
+
+    def test_no_log(self):
+        self.assertEqual(read_sent_emails(self.log_path, self.index_path),
+                         set())
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough of an SMTP server to receive emails."""
+    def reply(self, line: str) -> None:
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        self.reply('220 localhost')
+        recipients = []
+        for line in self.rfile:
+            command = line.decode().rstrip('\r\n')
+            server.commands.append(command)
+            verb = command.split(' ', 1)[0].split(':', 1)[0].upper()
+            if verb == 'EHLO':
+                if server.pipelining:
+                    self.reply('250-localhost')
+                    self.reply('250 PIPELINING')
+                else:
+                    self.reply('250 localhost')
+            elif verb == 'RCPT':
+                address = command.split(':', 1)[1].strip('<>')
+                if address in server.refused:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(address)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                if not recipients:
+                    self.reply('503 No valid recipients')
+                    continue
+                self.reply('354 Go ahead')
+                lines = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    lines.append(line[1:] if line.startswith(b'.') else line)
+                server.messages.append(b''.join(lines))
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, *, pipelining: bool = True,
+                 refused: frozenset[str] = frozenset()):
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.pipelining = pipelining
+        self.refused = refused
+        self.commands: list[str] = []
+        self.messages: list[bytes] = []
+
+
+def without_message_id(raw: bytes) -> bytes:
+    # Every call of Email.as_bytes() generates a new Message-ID.
+    return re.sub(br'Message-ID: .*\r\n', b'', raw)
+
+
+class TestSMTPSender(unittest.TestCase):
+    def start_server(self, **kwargs) -> FakeSMTPServer:
+        server = FakeSMTPServer(**kwargs)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def connect(self, server: FakeSMTPServer) -> SMTPSender:
+        host, port = server.server_address
+        sender = SMTPSender(
+                sender_address=DisplayAddress(email='me@example.com'),
+                smtpserver=host,
+                smtpuser='me',
+                smtpport=port)
+        self.addCleanup(sender.quit)
+        return sender
+
+    def transactions(self, server: FakeSMTPServer) -> list[str]:
+        # smtplib sends the verbs in lower case without pipelining.
+        commands = [command[:4].upper() + command[4:]
+                    for command in server.commands]
+        return [command for command in commands
+                if command.startswith(('MAIL FROM:', 'RCPT TO:'))
+                or command in ('DATA', 'RSET')]
+
+    def assertReceived(self, server: FakeSMTPServer, msgs: list[Email]):
+        self.assertEqual([without_message_id(raw) for raw in server.messages],
+                         [without_message_id(msg.as_bytes()) for msg in msgs])
+
+    def test_send_message(self):
+        for pipelining in [True, False]:
+            with self.subTest(pipelining=pipelining):
+                server = self.start_server(pipelining=pipelining)
+                msg = make_email()
+                self.connect(server).send_message(msg)
+                self.assertReceived(server, [msg])
+                self.assertEqual(self.transactions(server),
+                                 ['MAIL FROM:<me@example.com>',
+                                  'RCPT TO:<john.doe@example.com>',
+                                  'DATA'])
+
+    def test_refused_recipient(self):
+        for pipelining in [True, False]:
+            with self.subTest(pipelining=pipelining):
+                server = self.start_server(
+                        pipelining=pipelining,
+                        refused=frozenset(['nobody@example.com']))
+                sender = self.connect(server)
+                with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                    sender.send_message(
+                            make_email(to_email='nobody@example.com'))
+                # The connection can still be used for the next email.
+                msg = make_email()
+                sender.send_message(msg)
+                self.assertReceived(server, [msg])
+                self.assertIn('RSET', self.transactions(server))
+
+    def test_leading_dots_are_escaped(self):
+        for pipelining in [True, False]:
+            with self.subTest(pipelining=pipelining):
+                server = self.start_server(pipelining=pipelining)
+                msg = make_email(body='.\n..\n.leading dot\n')
+                self.connect(server).send_message(msg)
+                self.assertReceived(server, [msg])
+
+
+class TestCSVReader(unittest.TestCase):
+    def test_rows(self):
+        reader = CSVReader(io.StringIO('email,template,name\r\n'
+                                       'a@example.com,friends,Ann\r\n'
+                                       '\r\n'
+                                       'b@example.com,family\r\n'))
+        self.assertEqual(reader.fieldnames, ['email', 'template', 'name'])
+        self.assertEqual([dict(row) for row in reader],
+                         [{'email': 'a@example.com', 'template': 'friends',
+                           'name': 'Ann'},
+                          {'email': 'b@example.com', 'template': 'family'}])
+
+    def test_values(self):
+        reader = CSVReader(io.StringIO('email,template\n'
+                                       '\n'
+                                       'a@example.com,friends\n'))
+        self.assertEqual(list(reader.values()),
+                         [['a@example.com', 'friends']])
+
+    def test_short_row(self):
+        row = CSVRow({'email': 0, 'template': 1, 'name': 2},
+                     ['a@example.com', 'friends'])
+        self.assertEqual(row['template'], 'friends')
+        self.assertNotIn('name', row)
+        self.assertEqual(len(row), 2)
+        self.assertIsNone(row.get('name'))
+        with self.assertRaises(KeyError):
+            row['name']
+        with self.assertRaises(KeyError):
+            row['unknown']
+
+    def test_empty_file(self):
+        reader = CSVReader(io.StringIO(''))
+        self.assertEqual(reader.fieldnames, [])
+        self.assertEqual(list(reader), [])
+
+
+if __name__ == '__main__':
+    unittest.main()